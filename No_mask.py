@@ -17,8 +17,8 @@ def no_mask_integration(alpha,n,f,lambda1,field_of_view,z_field_of_view,zsteps,r
     gaussian=lambda theta:np.exp(-(np.sin(theta)*f/radius)**2)
 
     I1=np.zeros((ztotalsteps,rtotalsteps),dtype=complex)
-    I2=np.copy(I1)
-    I3=np.copy(I1)
+    I2=np.zeros_like(I1)
+    I3=np.zeros_like(I1)
 
     fun1=lambda theta: gaussian(theta)*np.cos(theta)**0.5*np.sin(theta)*(1+np.cos(theta))*jv(0,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
     fun2=lambda theta: gaussian(theta)*np.cos(theta)**0.5*np.sin(theta)**2*jv(1,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
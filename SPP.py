@@ -24,8 +24,8 @@ def SPP_simulation(polarization,phip0,beta,zp0,I0,alpha,n,f,radius_VPP,lambda1,z
     gaussian=lambda theta:np.exp(-(np.sin(theta)*f*10**-6)**2/radius**2)
     
     I1=np.zeros((ztotalsteps,rtotalsteps),dtype=complex)
-    I2=np.copy(I1)
-    I3=np.copy(I1)
+    I2=np.zeros_like(I1)
+    I3=np.zeros_like(I1)
     
     fun1=lambda theta: gaussian(theta)*np.cos(theta)**0.5*np.sin(2*theta)*2*jv(1,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
     fun2=lambda theta: gaussian(theta)*np.cos(theta)**0.5*np.sin(theta)*2*jv(1,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
@@ -67,10 +67,10 @@ def SPP_simulation(polarization,phip0,beta,zp0,I0,alpha,n,f,radius_VPP,lambda1,z
     xvalues=np.linspace(-field_of_view/2,field_of_view/2,np.int(np.rint(field_of_view/rsteps)))
     yvalues=np.linspace(field_of_view/2,-field_of_view/2,np.int(np.rint(field_of_view/rsteps)))
     Er_XY=np.zeros((x,y),dtype=complex)
-    Ephi_XY=np.copy(Er_XY)
-    Ez_XY=np.copy(Er_XY)
-    Ex_XY=np.copy(Er_XY)
-    Ey_XY=np.copy(Er_XY)
+    Ephi_XY=np.zeros_like(Er_XY)
+    Ez_XY=np.zeros_like(Er_XY)
+    Ex_XY=np.zeros_like(Er_XY)
+    Ey_XY=np.zeros_like(Er_XY)
 
     zz=ztotalsteps + int(np.rint(zp0/z_field_of_view*2*ztotalsteps))  #zz signals to the row of kz=kz0 in each II
     for xx,xpos in enumerate(xvalues):
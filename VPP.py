@@ -22,10 +22,10 @@ def VPP_integration(alpha,n,f,radius_VPP,lambda1,zsteps,rsteps,field_of_view,z_f
     gaussian=lambda theta:np.exp(-(np.sin(theta)*f/radius)**2)
     
     I1=np.zeros((ztotalsteps,rtotalsteps),dtype=complex)
-    I2=np.copy(I1)
-    I3=np.copy(I1)
-    I4=np.copy(I1)
-    I5=np.copy(I1)
+    I2=np.zeros_like(I1)
+    I3=np.zeros_like(I1)
+    I4=np.zeros_like(I1)
+    I5=np.zeros_like(I1)
     
     fun4=lambda theta: gaussian(theta)*np.cos(theta)**0.5*np.sin(theta)*(1 + np.cos(theta))*jv(1,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
     fun5=lambda theta: gaussian(theta)*np.cos(theta)**0.5*np.sin(theta)*(1 - np.cos(theta))*jv(1,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
@@ -124,10 +124,10 @@ def VPP_integration_with_L(alpha,n,f,radius_VPP,lambda1,zp0,zsteps,rsteps,field_
     rtotalsteps=np.int(np.rint(field_of_view/rsteps*2**0.5/2))
     
     I1=np.zeros(rtotalsteps,dtype=complex)
-    I2=np.copy(I1)
-    I3=np.copy(I1)
-    I4=np.copy(I1)
-    I5=np.copy(I1)
+    I2=np.zeros_like(I1)
+    I3=np.zeros_like(I1)
+    I4=np.zeros_like(I1)
+    I5=np.zeros_like(I1)
     
     fun4=lambda theta: E_theta(theta)*np.cos(theta)**0.5*np.sin(theta)*(1 + np.cos(theta))*jv(1,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
     fun5=lambda theta: E_theta(theta)*np.cos(theta)**0.5*np.sin(theta)*(1 - np.cos(theta))*jv(1,kr*np.sin(theta))*np.exp(1j*kz*np.cos(theta))
@@ -190,7 +190,7 @@ def VPP_pre_focus_opt(psi=45,delta=-90,steps=500,h=5,L=100,I_0=1,Lambda=0.00075,
     tot_xy=len(xyvalues)
     #Ei (i= x,y,z) are the fieds to calculate
     Ex=np.zeros((tot_xy,tot_xy),dtype=complex)
-    Ey=np.copy(Ex)
+    Ey=np.zeros_like(Ex)
     
     E_fun=lambda rho:2*np.pi*np.exp(1j*k*(L+rho**2/2/L))/Lambda/L*Int_interpolated(rho)
 
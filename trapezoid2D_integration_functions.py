@@ -7,35 +7,47 @@ Created on Mon Jun 15 17:40:54 2020
 Functions for simulation of the diffraction obtained by an arbitrary phase mask
 """
 
+import os
+os.environ.setdefault("OMP_NUM_THREADS","1") #keep NumPy's BLAS single-threaded so it does not oversubscribe the Numba parallel loops
+import cmath
+import math
+import functools
+from collections import namedtuple
 import numpy as np
+from numba import njit,prange
 from tqdm import tqdm
 from matplotlib import pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import time
 from scipy.optimize import minimize_scalar as minim
+from scipy.special import jv
 
-def generate_incident_field(maskfunction,alpha,focus,resolution_phi,resolution_theta,h,psi,delta,radius,I0,wavelength):
+def generate_incident_field(maskfunction,alpha,focus,resolution_phi,resolution_theta,h,psi,delta,radius,I0,wavelength,dtype=np.complex64):
     '''
     Generate a matrix for the field X and Y direction of the incident field on the lens, given the respective maskfunction
-    
+
     This matrix has the value of the amplitude of the incident field for each value of theta and phi
+
+    dtype is the complex type of the returned matrixes, single precision by default since it is plenty for a physical amplitude and halves the memory traffic of the focus field integration (use np.complex128 for double precision)
     '''
 
     k=2*np.pi/wavelength
-    gaussian= lambda rho: np.exp(-(rho/radius)**2)
-    ex_lens=np.zeros((resolution_phi,resolution_theta),dtype=complex)
-    ey_lens=np.zeros((resolution_phi,resolution_theta),dtype=complex)
+
+    #the polarization factors are computed once as plain Python scalars, which also keeps them from promoting the dtype of the field matrixes:
+    psi_rad=psi*math.pi/180
+    sqrt_I0=math.sqrt(I0)
+    phase_delta=cmath.exp(1j*delta*math.pi/180)
 
     theta_values=np.linspace(0,alpha,resolution_theta)  #divisions of theta in which the trapezoidal 2D integration is done
     rhop_values=np.sin(theta_values)*focus              #given by the sine's law
     phip_values=np.linspace(0,2*np.pi,resolution_phi)   #divisions of phi in which the trapezoidal 2D integration is done
-    for i,phip in enumerate(phip_values):
-        for j,rhop in enumerate(rhop_values):
-            phase=maskfunction(rhop,phip,radius,focus,k)
-            ex_lens[i,j]=gaussian(rhop)*phase
-            ey_lens[i,j]=gaussian(rhop)*phase
-    ex_lens*=np.cos(psi*np.pi/180)*I0**0.5
-    ey_lens*=np.sin(psi*np.pi/180)*np.exp(1j*delta*np.pi/180)*I0**0.5
+    rhop,phip=np.meshgrid(rhop_values,phip_values)      #turn the divisions into a matrix in order to apply the function more easily
+    gaussian=np.exp(-(rhop/radius)**2)
+    phase=maskfunction(rhop,phip,radius,focus,k)        #the mask function must accept arrays, as is already the case in custom_mask_objective_field
+    #ex_lens and ey_lens only differ by a global complex scalar, so the base field is computed and stored once:
+    base=(gaussian*phase).astype(dtype,copy=False)
+    ex_lens=base*(math.cos(psi_rad)*sqrt_I0)
+    ey_lens=base*(math.sin(psi_rad)*phase_delta*sqrt_I0)
     return ex_lens,ey_lens
 
 def plot_in_cartesian(Ex,Ey,xmax,alpha,focus,figure_name):
@@ -55,17 +67,17 @@ def plot_in_cartesian(Ex,Ey,xmax,alpha,focus,figure_name):
     phip_values=np.linspace(0,2*np.pi,resolution_phi)   #divisions of phi in which the trapezoidal 2D integration is done
     
     #passage from polar to cartesian coordinates, keep in mind the positions are not to be exact since the plot is on a grid
-    for i,x in enumerate(x_values):
-        for j,y in enumerate(y_values):
-            rhop=(x**2+y**2)**0.5
-            phip=np.arctan2(y,x)
-            if phip<0:
-                phip+=2*np.pi
-            if rhop<xmax:
-                id_rho = (np.abs(rhop_values - rhop)).argmin() #get the closest indent for the coordinate in which the field was calculated
-                id_phi = (np.abs(phip_values - phip)).argmin()
-                Ex_cartesian[j,i]=Ex[id_phi,id_rho]
-                Ey_cartesian[j,i]=Ey[id_phi,id_rho]
+    X,Y=np.meshgrid(x_values,y_values)
+    rhop=np.hypot(X,Y)
+    phip=np.arctan2(Y,X)%(2*np.pi)
+    #get the closest indent for the coordinate in which the field was calculated, searching on the sorted rhop_values and phip_values arrays:
+    id_rho=np.clip(np.searchsorted(rhop_values,rhop),1,len(rhop_values)-1)
+    id_rho=np.where(rhop-rhop_values[id_rho-1]<=rhop_values[id_rho]-rhop,id_rho-1,id_rho)
+    id_phi=np.clip(np.searchsorted(phip_values,phip),1,len(phip_values)-1)
+    id_phi=np.where(phip-phip_values[id_phi-1]<=phip_values[id_phi]-phip,id_phi-1,id_phi)
+    inside=rhop<xmax
+    Ex_cartesian[inside]=Ex[id_phi[inside],id_rho[inside]]
+    Ey_cartesian[inside]=Ey[id_phi[inside],id_rho[inside]]
 
     I_cartesian=np.abs(Ex_cartesian)**2+np.abs(Ey_cartesian)**2
     
@@ -129,22 +141,19 @@ def plot_in_cartesian(Ex,Ey,xmax,alpha,focus,figure_name):
     
     return I_cartesian,Ex_cartesian,Ey_cartesian
 
-def custom_mask_objective_field(psi,delta,resolution_theta,resolution_phi,N_rho,N_phi,alpha,mask_function,h,L,I0,Lambda,radius,fig_name,plot=True):
+@functools.lru_cache(maxsize=8)
+def _build_prefactor(N_rho,N_phi,h,radius,focus,Lambda,L,mask_function):
     '''
-    Difraction for an arbitrary phase mask under the paraxial approximation, using the GPU
-    
-    The resultant matrix Ex and Ey are outputed in polar coordinates (each row is a different value of phi and each column a different rho)  
+    Precompute the integration grid and the prefactor of custom_mask_objective_field, with the trapezoid weights absorbed
+
+    Cached so that parameter sweeps which keep the optical setup fixed (changing psi, delta, zp0, etc.) do not redo the mask evaluation.
+    mask_function is part of the cache key, so it must be the same function object between calls for the cache to hit.
+    The returned prefactor is marked read-only since it is shared between calls
     '''
-    
-    print('Calculating field at the objective:')
-    time.sleep(0.2)
-    focus=h/np.sin(alpha)
-    
-    #define divisions for the integration:
     rho_values=np.linspace(0,h,N_rho)
     phi_values=np.linspace(0,2*np.pi,N_phi)
     rho,phi=np.meshgrid(rho_values,phi_values)
-    
+
     #2D trapezoidal method weight:
     h_rho=h/N_rho
     h_phi=2*np.pi/N_phi
@@ -154,38 +163,92 @@ def custom_mask_objective_field(psi,delta,resolution_theta,resolution_phi,N_rho,
     weight_phi=np.zeros(N_phi)+h_phi
     weight_phi[0]=h_phi/2
     weight_phi[-1]=h_phi/2
-    weight=weight_rho*np.vstack(weight_phi)
 
-    #define coordinates in which to calculate the field:    
+    kl=np.pi/Lambda/L
+    k=2*np.pi/Lambda
+    #in order to save computing time, i do separatedly the calculation of terms that would otherwise be calculated multiple times, since they do not depend on rhop,phip (the coordinates at which the field is calculated)
+    prefactor=rho*np.exp(-(rho/radius)**2+1j*(k*L+kl*rho**2))*mask_function(rho,phi,radius,focus,k)
+    #the weights are separable, so instead of materializing the full weight matrix the 1D factors are absorbed into the prefactor:
+    prefactor=prefactor*weight_rho
+    prefactor*=weight_phi[:,None]
+    prefactor.setflags(write=False)
+    return rho,phi,prefactor
+
+def custom_mask_objective_field(psi,delta,resolution_theta,resolution_phi,N_rho,N_phi,alpha,mask_function,h,L,I0,Lambda,radius,fig_name,plot=True,method='direct'):
+    '''
+    Difraction for an arbitrary phase mask under the paraxial approximation, using the GPU
+
+    The resultant matrix Ex and Ey are outputed in polar coordinates (each row is a different value of phi and each column a different rho)
+
+    method='direct' sums the diffraction kernel explicitly. method='bessel' expands it with the Jacobi-Anger identity so the phi sum is done once per mode
+    instead of once per (phip,rhop); it is faster when 2*pi*h**2/Lambda/L (the number of Bessel modes needed) is small compared to resolution_phi*resolution_theta
+    '''
+    
+    print('Calculating field at the objective:')
+    time.sleep(0.2)
+    focus=h/np.sin(alpha)
+    #polarization scalars, converted from degrees once at entry:
+    psi_rad=psi*math.pi/180
+    sqrt_I0=math.sqrt(I0)
+    phase_delta=cmath.exp(1j*delta*math.pi/180)
+
+    #integration grid and prefactor, cached between calls that keep the optical setup fixed:
+    rho,phi,prefactor=_build_prefactor(N_rho,N_phi,h,radius,focus,Lambda,L,mask_function)
+    rho_values=rho[0,:]
+    phi_values=phi[:,0]
+
+    #define coordinates in which to calculate the field:
     theta_values=np.linspace(0,alpha,resolution_theta)  #divisions of theta in which the trapezoidal 2D integration is done
     rhop_values=np.sin(theta_values)*focus              #given by the sine's law
     phip_values=np.linspace(0,2*np.pi,resolution_phi)   #divisions of phi in which the trapezoidal 2D integration is done
 
-    #Define function to integrate and field matrix:    
+    #Define function to integrate and field matrix:
     Ex=np.zeros((resolution_phi,resolution_theta),dtype=complex)
     kl=np.pi/Lambda/L
     '''
     #the function to integrate is:
     f=lambda rho,phi: rho*np.exp(-(rho/radius)**2)*mask_function(rho,phi)*np.exp(1j*(kl*(rho**2-2*rho*rhop*np.cos(phi-phip))))
     '''
-    
+
     k=2*np.pi/Lambda
-    #in order to save computing time, i do separatedly the calculation of terms that would otherwise e claculated multiple times, since they do not depend on rhop,phip (the coordinates at which the field is calculated)
-    prefactor=rho*np.exp(-(rho/radius)**2+1j*(k*L+kl*rho**2))*mask_function(rho,phi,radius,focus,k)*weight
-    #numerical 2D integration: 
-    for j in tqdm(range(resolution_phi)):
-        phip=phip_values[j]
-        for i,rhop in enumerate(rhop_values):
-            phase=np.exp(1j*k*rhop**2/2/L)*np.exp(-1j*kl*(2*rho*rhop*np.cos(phi-phip)))         
-            Ex[j,i]=np.sum(prefactor*phase)
-    
+    rhop_phase=np.exp(1j*k*rhop_values**2/2/L)
+    chunk=64    #rhop values are tiled in blocks so that the phase matrix stays cache-sized
+    if method=='direct':
+        #numerical 2D integration: for each phip the sum over the (phi,rho) grid is done for all rhop at once as a matrix product, instead of one np.sum per rhop
+        prefactor_flat=prefactor.ravel()
+        rho_cos_phi=(rho*np.cos(phi)).ravel()
+        rho_sin_phi=(rho*np.sin(phi)).ravel()
+        for j in tqdm(range(resolution_phi)):
+            phip=phip_values[j]
+            rho_cos=rho_cos_phi*np.cos(phip)+rho_sin_phi*np.sin(phip)   #equals (rho*np.cos(phi-phip)).ravel()
+            for i in range(0,resolution_theta,chunk):
+                Ex[j,i:i+chunk]=np.exp(-2j*kl*np.outer(rhop_values[i:i+chunk],rho_cos))@prefactor_flat
+            Ex[j,:]*=rhop_phase
+    elif method=='bessel':
+        #Jacobi-Anger expansion: exp(-1j*a*cos(phi-phip))=sum_n (-1j)**n*J_n(a)*exp(1j*n*(phi-phip)),
+        #so the phi sum becomes one angular transform of the prefactor shared by every (phip,rhop) pair.
+        #the phi and phip grids include the 2*pi endpoint (with half trapezoid weights), so the angular
+        #transforms are done as dense matrix products instead of FFTs
+        alpha_max=2*kl*h*rhop_values[-1]                                        #largest argument of the Bessel functions
+        N_modes=int(np.ceil(alpha_max+10*alpha_max**(1/3)+10))                  #J_n(a) is negligible for n>a plus this margin
+        n_values=np.arange(-N_modes,N_modes+1)
+        prefactor_hat=np.exp(1j*np.outer(n_values,phi_values))@prefactor        #angular transform of the prefactor, one row per mode
+        synthesis=(-1j)**n_values[:,None]*np.exp(-1j*np.outer(n_values,phip_values))
+        for i in tqdm(range(0,resolution_theta,chunk)):
+            bessel_arg=2*kl*np.outer(rhop_values[i:i+chunk],rho_values)
+            modes=jv(n_values[:,None,None],bessel_arg[None,:,:])                #J_n for each (mode,rhop,rho)
+            Ex[:,i:i+chunk]=synthesis.T@np.einsum('nib,nb->ni',modes,prefactor_hat)
+        Ex*=rhop_phase
+    else:
+        raise ValueError('Options for method are \'direct\' and \'bessel\'')
+
     Ex*=-1j/Lambda/L
     
     #on this approximation, the field in the Y direction is the same as the field on the X direction with a different global phase and amplitude        
-    Ey=Ex*np.exp(1j*np.pi/180*delta)
-    Ex*=np.cos(np.pi/180*psi)*I0**0.5
-    Ey*=np.sin(np.pi/180*psi)*I0**0.5
-    
+    Ey=Ex*phase_delta
+    Ex*=math.cos(psi_rad)*sqrt_I0
+    Ey*=math.sin(psi_rad)*sqrt_I0
+
     I_cartesian,Ex_cartesian,Ey_cartesian=plot_in_cartesian(Ex,Ey,h,alpha,focus,fig_name)
         
     return Ex,Ey,I_cartesian,Ex_cartesian,Ey_cartesian
@@ -198,7 +261,11 @@ def test_custom_mask_objective_field(psi,delta,resolution_theta,resolution_phi,N
     print('Calculating field at the objective:')
     time.sleep(0.2)
     focus=h/np.sin(alpha)
-    
+    #degree-to-radian conversions and the amplitude, done once as Python scalars:
+    psi_rad=psi*math.pi/180
+    sqrt_I0=math.sqrt(I0)
+    phase_delta=cmath.exp(1j*delta*math.pi/180)
+
     #define divisions for the integration:
     rho_values=np.linspace(0,h,N_rho)
     phi_values=np.linspace(0,2*np.pi,N_phi)
@@ -213,7 +280,7 @@ def test_custom_mask_objective_field(psi,delta,resolution_theta,resolution_phi,N
     weight_phi=np.zeros(N_phi)+h_phi
     weight_phi[0]=h_phi/2
     weight_phi[-1]=h_phi/2
-    weight=weight_rho*np.vstack(weight_phi)
+    #the weights are separable, so instead of materializing the full weight matrix the 1D factors are absorbed into the prefactor below
     
     resolution_phi=int(resolution_phi/20) #only make 1/20 of the total calculation
     #define coordinates in which to calculate the field:    
@@ -230,51 +297,161 @@ def test_custom_mask_objective_field(psi,delta,resolution_theta,resolution_phi,N
     '''
     k=2*np.pi/Lambda
     #in order to save computing time, i do separatedly the calculation of terms that would otherwise e claculated multiple times, since they do not depend on rhop,phip (the coordinates at which the field is calculated)
-    prefactor=rho*np.exp(-(rho/radius)**2)*mask_function(rho,phi)*weight
+    prefactor=rho*np.exp(-(rho/radius)**2)*mask_function(rho,phi)
+    prefactor*=weight_rho
+    prefactor*=weight_phi[:,None]
 
-    #numerical 2D integration: 
+    #numerical 2D integration: for each phip the sum over the (phi,rho) grid is done for all rhop at once as a matrix product, instead of one np.sum per rhop
+    prefactor_flat=(prefactor*np.exp(1j*kl*rho**2)).ravel()
+    rho_cos_phi=(rho*np.cos(phi)).ravel()
+    rho_sin_phi=(rho*np.sin(phi)).ravel()
+    rhop_phase=np.exp(1j*k*(L+rhop_values**2/2/L))
+    chunk=64    #rhop values are tiled in blocks so that the phase matrix stays cache-sized
     for j in tqdm(range(resolution_phi)):
         phip=phip_values[j]
-        for i,rhop in enumerate(rhop_values):
-            phase=np.exp(1j*k*(L+rhop**2/2/L))*np.exp(1j*(kl*(rho**2-2*rho*rhop*np.cos(phi-phip))))         
-            Ex[j,i]=np.sum(prefactor*phase)
-    
+        rho_cos=rho_cos_phi*np.cos(phip)+rho_sin_phi*np.sin(phip)   #equals (rho*np.cos(phi-phip)).ravel()
+        for i in range(0,resolution_theta,chunk):
+            Ex[j,i:i+chunk]=np.exp(-2j*kl*np.outer(rhop_values[i:i+chunk],rho_cos))@prefactor_flat
+        Ex[j,:]*=rhop_phase
+
     Ex*=-1j/Lambda/L
 
     #on this approximation, the field in the Y direction is the same as the field on the X direction with a different global phase and amplitude        
-    Ey=Ex*np.exp(1j*np.pi/180*delta)
-    Ex*=np.cos(np.pi/180*psi)*I0**0.5
-    Ey*=np.sin(np.pi/180*psi)*I0**0.5
+    Ey=Ex*phase_delta
+    Ex*=math.cos(psi_rad)*sqrt_I0
+    Ey*=math.sin(psi_rad)*sqrt_I0
 
     I_cartesian,Ex_cartesian,Ey_cartesian=plot_in_cartesian(Ex,Ey,h,alpha,focus)
 
     return Ex,Ey,I_cartesian,Ex_cartesian,Ey_cartesian
 
-def custom_mask_focus_field(ex_lens,ey_lens,alpha,h,Lambda,zp0,resolution_focus,resolution_theta,resolution_phi,FOV_focus,countdown=True,x0=0,y0=0):
+def _pixel_coordinates(x_values,y_values,Lambda,real_dtype):
     '''
-    High apperture difraction for an arbitrary incident field. Only calculates the field on the XY focal plane.
-    
-    countdown=True means you are only running this fuction once and you want to see te time elapsed and expected to finish the calculation
-    
-    x0 and y0 are used for calculating the field centered at an x0, y0 position
+    Precompute kr, cos(phip) and sin(phip) for every pixel of the plot grid at once, in the i (x, outer) then j (y, inner) order of the pixel loops
     '''
-    
-    if countdown==True:
-        print('Calculating field at the focal plane:')
-        time.sleep(0.5)
-    Lambda*=10**6
-    focus=h/np.sin(alpha)*10**6
-        
-    #The Y component of incident field must be evaluated at phi-pi-pi/2, which is equivalent to moving the rows of the matrix    
-    def rotate_90º(matrix):
-        a,b=np.shape(matrix)       
-        aux=np.zeros((a,b),dtype=complex)        
-        for i in range(a):
-            aux[i-int(3*a/4),:]=matrix[i,:]
-        return aux
-
-    ey_lens=rotate_90º(ey_lens)
-    
+    x=np.repeat(x_values,len(y_values))
+    y=np.tile(y_values,len(x_values))
+    kr=(np.hypot(x,y)*2*np.pi/Lambda).astype(real_dtype,order='C')
+    phip=np.arctan2(y,x)
+    cos_phip=np.cos(phip).astype(real_dtype,order='C')
+    sin_phip=np.sin(phip).astype(real_dtype,order='C')
+    return kr,cos_phip,sin_phip
+
+@njit(parallel=True,fastmath=True,cache=True)
+def _focus_field_pixel_loop(ex,ey,ez,Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta,cos_phi,sin_phi,kr,cos_phip,sin_phip,kz):
+    '''
+    Numba-compiled pixel loop for the focus field integrations, filling the preallocated flat arrays ex,ey,ez
+
+    kr, cos_phip, sin_phip and kz give the precomputed coordinates of each pixel.
+    For each pixel the 3 integrals over the (phi,theta) grid are accumulated in a single fused pass, with the pixels distributed between threads
+    '''
+    n_pixels=len(ex)
+    n_phi,n_theta=np.shape(Axx)
+    for p in prange(n_pixels):
+        sx=0j
+        sy=0j
+        sz=0j
+        for a in range(n_phi):
+            for b in range(n_theta):
+                #cos(phi-phip) and sin(phi-phip) are expanded with the angle-difference identity, using the cached sincos of phip
+                cos_pm=cos_phi[a,b]*cos_phip[p]+sin_phi[a,b]*sin_phip[p]
+                sin_pm=sin_phi[a,b]*cos_phip[p]-cos_phi[a,b]*sin_phip[p]
+                phase_inc_x=cmath.exp(1j*(sin_theta[a,b]*kr[p]*cos_pm+cos_theta[a,b]*kz[p]))#phase for the X incident component
+                phase_inc_y=cmath.exp(1j*(-sin_theta[a,b]*kr[p]*sin_pm+cos_theta[a,b]*kz[p]))#phase for the Y incident component
+                sx+=Axx[a,b]*phase_inc_x+Ayx[a,b]*phase_inc_y
+                sy+=Axy[a,b]*phase_inc_x+Ayy[a,b]*phase_inc_y
+                sz+=Axz[a,b]*phase_inc_x+Ayz[a,b]*phase_inc_y
+        ex[p]=sx
+        ey[p]=sy
+        ez[p]=sz
+
+def _focus_field_pixel_matmul(Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta_kz,cos_phi,sin_phi,kr,cos_phip,sin_phip):
+    '''
+    Pure NumPy alternative to _focus_field_pixel_loop, returning the flat ex,ey,ez arrays for the precomputed pixel coordinates kr, cos_phip, sin_phip
+
+    Pixels are processed in tiles: for each tile the (tile,N_phi*N_theta) phase matrix is built by broadcasting and the 3 integrals are done as BLAS matrix products against the flattened A tensors
+    '''
+    n_pixels=len(kr)
+    #the A tensors are stacked so each phase matrix is contracted against all 3 components in a single product:
+    A_stack_x=np.stack((Axx.ravel(),Axy.ravel(),Axz.ravel()),axis=1)
+    A_stack_y=np.stack((Ayx.ravel(),Ayy.ravel(),Ayz.ravel()),axis=1)
+    sin_theta_flat=sin_theta.ravel()
+    cos_theta_kz_flat=cos_theta_kz.ravel()
+    cos_phi_flat=cos_phi.ravel()
+    sin_phi_flat=sin_phi.ravel()
+
+    ex_flat=np.zeros(n_pixels,dtype=Axx.dtype)
+    ey_flat=np.zeros(n_pixels,dtype=Axx.dtype)
+    ez_flat=np.zeros(n_pixels,dtype=Axx.dtype)
+    tile=64     #pixels per tile, so that the phase matrix stays cache-sized
+    for t in range(0,n_pixels,tile):
+        sl=slice(t,t+tile)
+        cos_pm=np.outer(cos_phip[sl],cos_phi_flat)+np.outer(sin_phip[sl],sin_phi_flat)  #cos(phi-phip) by the angle-difference identity
+        sin_pm=np.outer(cos_phip[sl],sin_phi_flat)-np.outer(sin_phip[sl],cos_phi_flat)  #sin(phi-phip)
+        arg_x=kr[sl,None]*sin_theta_flat*cos_pm+cos_theta_kz_flat
+        arg_y=-kr[sl,None]*sin_theta_flat*sin_pm+cos_theta_kz_flat
+        phase_inc_x=np.cos(arg_x)+1j*np.sin(arg_x)#phase for the X incident component
+        phase_inc_y=np.cos(arg_y)+1j*np.sin(arg_y)#phase for the Y incident component
+        e_tile=phase_inc_x@A_stack_x+phase_inc_y@A_stack_y
+        ex_flat[sl]=e_tile[:,0]
+        ey_flat[sl]=e_tile[:,1]
+        ez_flat[sl]=e_tile[:,2]
+    return ex_flat,ey_flat,ez_flat
+
+def _focus_field_pixel_cupy(Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta_kz,cos_phi,sin_phi,kr,cos_phip,sin_phip):
+    '''
+    CuPy version of _focus_field_pixel_matmul: the same tiled contraction is run on the GPU
+
+    cupy is imported here so that the rest of the module keeps working on machines without a GPU
+    '''
+    import cupy as cp
+
+    n_pixels=len(kr)
+    #the A tensors are stacked so each phase matrix is contracted against all 3 components in a single product:
+    A_stack_x=cp.stack((cp.asarray(Axx).ravel(),cp.asarray(Axy).ravel(),cp.asarray(Axz).ravel()),axis=1)
+    A_stack_y=cp.stack((cp.asarray(Ayx).ravel(),cp.asarray(Ayy).ravel(),cp.asarray(Ayz).ravel()),axis=1)
+    sin_theta_flat=cp.asarray(sin_theta).ravel()
+    cos_theta_kz_flat=cp.asarray(cos_theta_kz).ravel()
+    cos_phi_flat=cp.asarray(cos_phi).ravel()
+    sin_phi_flat=cp.asarray(sin_phi).ravel()
+    kr=cp.asarray(kr)
+    cos_phip=cp.asarray(cos_phip)
+    sin_phip=cp.asarray(sin_phip)
+
+    ex_flat=cp.zeros(n_pixels,dtype=Axx.dtype)
+    ey_flat=cp.zeros(n_pixels,dtype=Axx.dtype)
+    ez_flat=cp.zeros(n_pixels,dtype=Axx.dtype)
+    tile=1024   #pixels per tile, the GPU is better fed with larger phase matrices than the CPU path
+    for t in range(0,n_pixels,tile):
+        sl=slice(t,t+tile)
+        cos_pm=cp.outer(cos_phip[sl],cos_phi_flat)+cp.outer(sin_phip[sl],sin_phi_flat)  #cos(phi-phip) by the angle-difference identity
+        sin_pm=cp.outer(cos_phip[sl],sin_phi_flat)-cp.outer(sin_phip[sl],cos_phi_flat)  #sin(phi-phip)
+        arg_x=kr[sl,None]*sin_theta_flat*cos_pm+cos_theta_kz_flat
+        arg_y=-kr[sl,None]*sin_theta_flat*sin_pm+cos_theta_kz_flat
+        phase_inc_x=cp.cos(arg_x)+1j*cp.sin(arg_x)#phase for the X incident component
+        phase_inc_y=cp.cos(arg_y)+1j*cp.sin(arg_y)#phase for the Y incident component
+        e_tile=phase_inc_x@A_stack_x+phase_inc_y@A_stack_y
+        ex_flat[sl]=e_tile[:,0]
+        ey_flat[sl]=e_tile[:,1]
+        ez_flat[sl]=e_tile[:,2]
+    return cp.asnumpy(ex_flat),cp.asnumpy(ey_flat),cp.asnumpy(ez_flat)
+
+#the six A tensors and the trigonometric grids are shared between the XY and XZ/YZ integrations:
+FocusFieldTensors=namedtuple('FocusFieldTensors','Axx Axy Axz Ayx Ayy Ayz sin_theta cos_theta cos_phi sin_phi')
+
+def _build_A_tensors(ex_lens,ey_lens,alpha,resolution_theta,resolution_phi,dtype=np.complex64):
+    '''
+    Precompute the 6 tensors A_ij=prefactor_j*e_i_lens*weight and the trigonometric grids used by the focus field integrations
+
+    Called once per incident field: custom_mask_focus_field_XZ_XY reuses the same tensors for the XY plane and the XZ/YZ plane.
+    The returned arrays are marked read-only since they are shared between calls.
+    dtype sets the precision of the integration: the A tensors are cast to it and the trigonometric grids to the matching real type
+    '''
+    #the incident fields could be non-contiguous views (a transpose or a slice), which would propagate into the A tensors:
+    ex_lens=np.ascontiguousarray(ex_lens)
+    #The Y component of incident field must be evaluated at phi-pi-pi/2, which is equivalent to moving the rows of the matrix
+    ey_lens=np.roll(np.ascontiguousarray(ey_lens),-int(3*np.shape(ey_lens)[0]/4),axis=0)
+
     '''
     # the functions i am going to integrate are:
     fun1=lambda phi,theta: np.cos(theta)**0.5*np.sin(theta)*(np.cos(theta) + (1 - np.cos(theta))*np.sin(phi)**2)*np.exp(1j*(np.sin(theta)*kr*np.cos(phi - phip) + np.cos(theta)*kz))
@@ -283,7 +460,7 @@ def custom_mask_focus_field(ex_lens,ey_lens,alpha,h,Lambda,zp0,resolution_focus,
     fun4=lambda phi,theta: np.cos(theta)**0.5*np.sin(theta)*(1 - np.cos(theta))*np.cos(phi)*np.sin(phi)*np.exp(1j*(-np.sin(theta)*kr*np.sin(phi - phip) + np.cos(theta)*kz))
     fun5=lambda phi,theta: np.cos(theta)**0.5*np.sin(theta)*(np.cos(theta) + (1 - np.cos(theta))*np.sin(phi)**2)*np.exp(1j*(-np.sin(theta)*kr*np.sin(phi - phip) + np.cos(theta)*kz))
     fun6=lambda phi,theta: np.cos(theta)**0.5*np.sin(theta)**2*np.cos(phi)*np.exp(1j*(-np.sin(theta)*kr*np.sin(phi - phip) + np.cos(theta)*kz))
-    '''  
+    '''
     #2D trapezoidal method weight:
     h_theta=alpha/resolution_theta
     h_phi=2*np.pi/resolution_phi
@@ -293,199 +470,157 @@ def custom_mask_focus_field(ex_lens,ey_lens,alpha,h,Lambda,zp0,resolution_focus,
     weight_trapezoid_phi=np.zeros(resolution_phi)+h_phi
     weight_trapezoid_phi[0]=h_phi/2
     weight_trapezoid_phi[-1]=h_phi/2
-    weight_trapezoid=weight_trapezoid_rho*np.vstack(weight_trapezoid_phi)#represents the area of each trapezoid for each position in phi,theta
-    
-    #define coordinates in which to calculate the field:    
-    xmax=FOV_focus/2
-    x_values=np.linspace(-xmax+x0,xmax+x0,resolution_focus)
-    y_values=np.linspace(xmax+y0,-xmax+y0,resolution_focus)
-    ex=np.zeros((resolution_focus,resolution_focus),dtype=complex)
-    ey=np.copy(ex)
-    ez=np.copy(ex)
-    
+    #the weights are separable, so instead of materializing the full weight matrix the 1D factors are absorbed into the prefactor below
+
     #define divisions for the integration:
     theta_values=np.linspace(0,alpha,resolution_theta)    #divisions of theta in which the trapezoidal 2D integration is done
     phi_values=np.linspace(0,2*np.pi,resolution_phi)      #divisions of phi in which the trapezoidal 2D integration is done
     theta,phi=np.meshgrid(theta_values,phi_values)        #turn the divisions into a matrix in order to apply the function more easily
 
-    kz=zp0*2*np.pi/Lambda
-
-    #now begins the integration, in order to save computing time i do the trigonometric functions separatedly and save the value into another variable
+    #in order to save computing time i do the trigonometric functions separatedly and save the value into another variable
     cos_theta=np.cos(theta)
     cos_theta_sqrt=cos_theta**0.5
     sin_theta=np.sin(theta)
     cos_phi=np.cos(phi)
     sin_phi=np.sin(phi)
     sin_phi_square=sin_phi**2
-    
+
     prefactor_general=cos_theta_sqrt*sin_theta
+    prefactor_general*=weight_trapezoid_rho          #the trapezoid area for each position in phi,theta enters every A tensor,
+    prefactor_general*=weight_trapezoid_phi[:,None]  #so both 1D weight factors are applied here once
     prefactor_x=prefactor_general*(cos_theta+(1-cos_theta)*sin_phi_square)
     prefactor_y=prefactor_general*(1-cos_theta)*cos_phi*sin_phi
     prefactor_z=prefactor_general*sin_theta*cos_phi
-    
-    Axx=prefactor_x*ex_lens*weight_trapezoid
-    Axy=prefactor_y*ex_lens*weight_trapezoid
-    Axz=prefactor_z*ex_lens*weight_trapezoid
 
-    Ayx=prefactor_y*ey_lens*weight_trapezoid
-    Ayy=-prefactor_x*ey_lens*weight_trapezoid
-    Ayz=prefactor_z*ey_lens*weight_trapezoid
+    Axx=prefactor_x*ex_lens
+    Axy=prefactor_y*ex_lens
+    Axz=prefactor_z*ex_lens
+
+    Ayx=prefactor_y*ey_lens
+    Ayy=-prefactor_x*ey_lens
+    Ayz=prefactor_z*ey_lens
+
+    real_dtype=np.zeros(0,dtype=dtype).real.dtype
+    #the casts are forced C-contiguous so the compiled pixel loop always sees unit-stride rows and can vectorize them:
+    tensors=FocusFieldTensors(Axx.astype(dtype,order='C'),Axy.astype(dtype,order='C'),Axz.astype(dtype,order='C'),
+                              Ayx.astype(dtype,order='C'),Ayy.astype(dtype,order='C'),Ayz.astype(dtype,order='C'),
+                              sin_theta.astype(real_dtype,order='C'),cos_theta.astype(real_dtype,order='C'),
+                              cos_phi.astype(real_dtype,order='C'),sin_phi.astype(real_dtype,order='C'))
+    for matrix in tensors:
+        matrix.setflags(write=False)
+    return tensors
+
+def custom_mask_focus_field(ex_lens,ey_lens,alpha,h,Lambda,zp0,resolution_focus,resolution_theta,resolution_phi,FOV_focus,countdown=True,x0=0,y0=0,backend='numba',tensors=None,dtype=np.complex64):
+    '''
+    High apperture difraction for an arbitrary incident field. Only calculates the field on the XY focal plane.
+
+    countdown=True means you are only running this fuction once and you want to see te time elapsed and expected to finish the calculation
+
+    x0 and y0 are used for calculating the field centered at an x0, y0 position
+
+    backend='numba' uses the compiled parallel pixel loop, backend='numpy' uses tiled BLAS matrix products instead and backend='cupy' runs the same contraction on the GPU (requires cupy)
+
+    tensors can be given as the result of _build_A_tensors to avoid rebuilding the A tensors on repeated calls for the same incident field
+
+    dtype is the complex type at which the integration is done, single precision by default (use np.complex128 for double precision)
+    '''
 
-    cos_theta_kz=cos_theta*kz
-    #now for each position in which i calculate the field i do the integration
     if countdown==True:
-        for i in tqdm(range(resolution_focus),desc='XY plane'):
-            x=x_values[i]
-            for j,y in enumerate(y_values):#idea, rotar en phi es correr las columnas de la matriz ex, ey
-                rhop=(x**2+y**2)**0.5
-                phip=np.arctan2(y,x)
-                kr=rhop*2*np.pi/Lambda
-                sin_theta_kr=sin_theta*kr
-                phase_inc_x=np.exp(1j*(sin_theta_kr*np.cos(phi - phip) + cos_theta_kz))#phase for the X incident component
-                phase_inc_y=np.exp(1j*(-sin_theta_kr*np.sin(phi - phip) + cos_theta_kz))#phase for the Y incident component
-                #now, the integration is made as the sum of the value of the integrand in each position of phi,theta:
-                ex[j,i]=np.sum(Axx*phase_inc_x)+np.sum(Ayx*phase_inc_y) 
-                ey[j,i]=np.sum(Axy*phase_inc_x)+np.sum(Ayy*phase_inc_y)
-                ez[j,i]=np.sum(Axz*phase_inc_x)+np.sum(Ayz*phase_inc_y)
+        print('Calculating field at the focal plane:')
+        time.sleep(0.5)
+    Lambda*=10**6
+    focus=h/np.sin(alpha)*10**6
+
+    if tensors is None:
+        tensors=_build_A_tensors(ex_lens,ey_lens,alpha,resolution_theta,resolution_phi,dtype=dtype)
+    Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta,cos_phi,sin_phi=tensors
+
+    #define coordinates in which to calculate the field:
+    xmax=FOV_focus/2
+    x_values=np.linspace(-xmax+x0,xmax+x0,resolution_focus)
+    y_values=np.linspace(xmax+y0,-xmax+y0,resolution_focus)
+
+    #the pixel coordinates are precomputed once for the whole grid instead of inside the pixel loop:
+    kr,cos_phip,sin_phip=_pixel_coordinates(x_values,y_values,Lambda,sin_theta.dtype)
+    kz=zp0*2*np.pi/Lambda
+    #now for each position in which i calculate the field i do the integration, either with the numba compiled pixel loop or with the tiled matrix products
+    if backend=='numba':
+        ex_flat=np.zeros(resolution_focus**2,dtype=Axx.dtype)
+        ey_flat=np.zeros(resolution_focus**2,dtype=Axx.dtype)
+        ez_flat=np.zeros(resolution_focus**2,dtype=Axx.dtype)
+        kz_pixels=np.full(resolution_focus**2,kz,dtype=sin_theta.dtype)
+        _focus_field_pixel_loop(ex_flat,ey_flat,ez_flat,Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta,cos_phi,sin_phi,kr,cos_phip,sin_phip,kz_pixels)
+    elif backend=='numpy':
+        ex_flat,ey_flat,ez_flat=_focus_field_pixel_matmul(Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta*kz,cos_phi,sin_phi,kr,cos_phip,sin_phip)
+    elif backend=='cupy':
+        ex_flat,ey_flat,ez_flat=_focus_field_pixel_cupy(Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta*kz,cos_phi,sin_phi,kr,cos_phip,sin_phip)
     else:
-        for i,x in enumerate(x_values):
-            for j,y in enumerate(y_values):
-                rhop=(x**2+y**2)**0.5
-                phip=np.arctan2(y,x)
-                kr=rhop*2*np.pi/Lambda
-                sin_theta_kr=sin_theta*kr
-                phase_inc_x=np.exp(1j*(sin_theta_kr*np.cos(phi - phip) + cos_theta_kz))#phase for the X incident component
-                phase_inc_y=np.exp(1j*(-sin_theta_kr*np.sin(phi - phip) + cos_theta_kz))#phase for the Y incident component
-                #now, the integration is made as the sum of the value of the integrand in each position of phi,theta:
-                ex[j,i]=np.sum(Axx*phase_inc_x)+np.sum(Ayx*phase_inc_y)
-                ey[j,i]=np.sum(Axy*phase_inc_x)+np.sum(Ayy*phase_inc_y)
-                ez[j,i]=np.sum(Axz*phase_inc_x)+np.sum(Ayz*phase_inc_y)
-        
+        raise ValueError('Options for backend are \'numba\', \'numpy\' and \'cupy\'')
+    #pixel p maps to matrix position [j,i] with i=p//resolution_focus, j=p%resolution_focus:
+    ex=np.ascontiguousarray(ex_flat.reshape(resolution_focus,resolution_focus).T)
+    ey=np.ascontiguousarray(ey_flat.reshape(resolution_focus,resolution_focus).T)
+    ez=np.ascontiguousarray(ez_flat.reshape(resolution_focus,resolution_focus).T)
+
     ex*=-1j*focus/Lambda
     ey*=1j*focus/Lambda
     ez*=1j*focus/Lambda
     
     return ex,ey,ez
 
-def custom_mask_focus_field_XZ_XY(ex_lens,ey_lens,alpha,h,Lambda,z_FOV,resolution_z,zp0,resolution_focus,resolution_theta,resolution_phi,FOV_focus,x0=0,y0=0,plot_plane='X'):
+def custom_mask_focus_field_XZ_XY(ex_lens,ey_lens,alpha,h,Lambda,z_FOV,resolution_z,zp0,resolution_focus,resolution_theta,resolution_phi,FOV_focus,x0=0,y0=0,plot_plane='X',dtype=np.complex64):
     '''
     High apperture difraction for an arbitrary incident field. Calculates the field on the XY and XZ focal planes.
-        
+
     x0 and y0 are used for calculating the field centered at an x0, y0 position
-    
+
     plot_plane='X' is used for calculating the XZ plane, otherwise plot_plane='Y' calculates the YZ plane
+
+    dtype is the complex type at which the integration is done, single precision by default (use np.complex128 for double precision)
     '''
-    #XY plane: 
-    Ex_XY,Ey_XY,Ez_XY=custom_mask_focus_field(ex_lens,ey_lens,alpha,h,Lambda,zp0,resolution_focus,resolution_theta,resolution_phi,FOV_focus,countdown=True,x0=x0,y0=y0)
-    
+    #the A tensors are built once and shared between the XY and the XZ/YZ integrations:
+    tensors=_build_A_tensors(ex_lens,ey_lens,alpha,resolution_theta,resolution_phi,dtype=dtype)
+    Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta,cos_phi,sin_phi=tensors
+
+    #XY plane:
+    Ex_XY,Ey_XY,Ez_XY=custom_mask_focus_field(ex_lens,ey_lens,alpha,h,Lambda,zp0,resolution_focus,resolution_theta,resolution_phi,FOV_focus,countdown=True,x0=x0,y0=y0,tensors=tensors)
+
     #XZ plane:
     if int(resolution_z%2)==0:
         resolution_z+=1    #make the middle coordinate on Z be Z=0
-        
+
     Lambda*=10**6               #passage from mm to nm
     focus=h/np.sin(alpha)*10**6 #passage from mm to nm
-        
-    #The Y component of incident field must be evaluated at phi-pi/2, which is equivalent to moving the rows of the matrix    
-    def rotate_90º(matrix):
-        a,b=np.shape(matrix)       
-        aux=np.zeros((a,b),dtype=complex)        
-        for i in range(a):
-            aux[i-int(3*a/4),:]=matrix[i,:]
-        return aux
-
-    ey_lens=rotate_90º(ey_lens)
 
-    '''
-    # the functions i am going to integrate are:
-    fun1=lambda theta, phi: np.cos(theta)**0.5*np.sin(theta)*(np.cos(theta) + (1 - np.cos(theta))*np.sin(phi)**2)*np.exp(1j*(np.sin(theta)*kr*np.cos(phi - phip) + np.cos(theta)*kz))
-    fun2=lambda theta, phi: np.cos(theta)**0.5*np.sin(theta)*(1 - np.cos(theta))*np.cos(phi)*np.sin(phi)*np.exp(1j*(np.sin(theta)*kr*np.cos(phi - phip) + np.cos(theta)*kz))
-    fun3=lambda theta, phi: np.cos(theta)**0.5*np.sin(theta)**2*np.cos(phi)*np.exp(1j*(np.sin(theta)*kr*np.cos(phi - phip) + np.cos(theta)*kz))
-    fun4=lambda theta, phi: np.cos(theta)**0.5*np.sin(theta)*(1 - np.cos(theta))*np.cos(phi)*np.sin(phi)*np.exp(1j*(-np.sin(theta)*kr*np.sin(phi - phip) + np.cos(theta)*kz))
-    fun5=lambda theta, phi: np.cos(theta)**0.5*np.sin(theta)*(np.cos(theta) + (1 - np.cos(theta))*np.sin(phi)**2)*np.exp(1j*(-np.sin(theta)*kr*np.sin(phi - phip) + np.cos(theta)*kz))
-    fun6=lambda theta, phi: np.cos(theta)**0.5*np.sin(theta)**2*np.cos(phi)*np.exp(1j*(-np.sin(theta)*kr*np.sin(phi - phip) + np.cos(theta)*kz))
-    '''  
-        
-    #2D trapezoidal method weight:
-    h_theta=alpha/resolution_theta
-    h_phi=2*np.pi/resolution_phi
-    weight_trapezoid_rho=np.zeros(resolution_theta)+h_theta
-    weight_trapezoid_rho[0]=h_theta/2
-    weight_trapezoid_rho[-1]=h_theta/2
-    weight_trapezoid_phi=np.zeros(resolution_phi)+h_phi
-    weight_trapezoid_phi[0]=h_phi/2
-    weight_trapezoid_phi[-1]=h_phi/2
-    weight_trapezoid=weight_trapezoid_rho*np.vstack(weight_trapezoid_phi) #represents the area of each trapezoid for each position in phi,theta
-
-    #define coordinates in which to calculate the field:                
+    #define coordinates in which to calculate the field:
     xmax=FOV_focus*2**0.5/2  #I want to plot up to FOV*2**0.5
     x_values=np.linspace(-xmax+x0,xmax+x0,resolution_focus)
     z_values=np.linspace(z_FOV/2,-z_FOV/2,resolution_z)
-    
-    Ex_XZ=np.zeros((resolution_z,resolution_focus),dtype=complex)
-    Ey_XZ=np.copy(Ex_XZ)
-    Ez_XZ=np.copy(Ex_XZ)
-        
-    #define divisions for the integration:
-    theta_values=np.linspace(0,alpha,resolution_theta)    #divisions of theta in which the trapezoidal 2D integration is done
-    phi_values=np.linspace(0,2*np.pi,resolution_phi)      #divisions of phi in which the trapezoidal 2D integration is done
-    theta,phi=np.meshgrid(theta_values,phi_values)        #turn the divisions into a matrix in order to apply the function more easily
-    
-    #now begins the integration, in order to save computing time i do the trigonometric functions separatedly and save the value into another variable
-    cos_theta=np.cos(theta)
-    cos_theta_sqrt=cos_theta**0.5
-    sin_theta=np.sin(theta)
-    cos_phi=np.cos(phi)
-    sin_phi=np.sin(phi)
-    sin_phi_square=sin_phi**2
-    
-    prefactor_general=cos_theta_sqrt*sin_theta
-    prefactor_x=prefactor_general*(cos_theta+(1-cos_theta)*sin_phi_square)
-    prefactor_y=prefactor_general*(1-cos_theta)*cos_phi*sin_phi
-    prefactor_z=prefactor_general*sin_theta*cos_phi
-
-    Axx=prefactor_x*ex_lens*weight_trapezoid
-    Axy=prefactor_y*ex_lens*weight_trapezoid
-    Axz=prefactor_z*ex_lens*weight_trapezoid
-
-    Ayx=prefactor_y*ey_lens*weight_trapezoid
-    Ayy=-prefactor_x*ey_lens*weight_trapezoid
-    Ayz=prefactor_z*ey_lens*weight_trapezoid
 
+    #the pixel coordinates are precomputed once for the whole plane instead of inside the loops.
+    #the X and Y planes share the whole integration, they only differ in the azimutal angle of the pixels:
     if plot_plane=='X':
-        for j in tqdm(range(resolution_z),desc='XZ plane'):
-            zp0=z_values[j]
-            for i,x in enumerate(x_values):#idea, rotar en phi es correr las columnas de la matriz ex, ey
-                rhop=np.abs(x)
-                phip=np.arctan2(0,x)
-                kr=rhop*2*np.pi/Lambda
-                kz=zp0*2*np.pi/Lambda
-                sin_theta_kr=sin_theta*kr
-                cos_theta_kz=cos_theta*kz
-                phase_inc_x=np.exp(1j*(sin_theta_kr*np.cos(phi - phip) + cos_theta_kz))#phase for the X incident component
-                phase_inc_y=np.exp(1j*(-sin_theta_kr*np.sin(phi - phip) + cos_theta_kz))#phase for the Y incident component
-                #now, the integration is made as the sum of the value of the integrand in each position of phi,theta:
-                Ex_XZ[j,i]=np.sum(Axx*phase_inc_x)+np.sum(Ayx*phase_inc_y)
-                Ey_XZ[j,i]=np.sum(Axy*phase_inc_x)+np.sum(Ayy*phase_inc_y)
-                Ez_XZ[j,i]=np.sum(Axz*phase_inc_x)+np.sum(Ayz*phase_inc_y)
+        phip_values=np.arctan2(0,x_values)
+    elif plot_plane=='Y':
+        phip_values=np.arctan2(x_values,0)
     else:
-        if plot_plane=='Y':           
-            for j in tqdm(range(resolution_z),desc='YZ plane'):
-                zp0=z_values[j]
-                for i,y in enumerate(x_values):#idea, rotar en phi es correr las columnas de la matriz ex, ey
-                    rhop=np.abs(y)
-                    phip=np.arctan2(y,0)
-                    kr=rhop*2*np.pi/Lambda
-                    kz=zp0*2*np.pi/Lambda
-                    sin_theta_kr=sin_theta*kr
-                    cos_theta_kz=cos_theta*kz
-                    phase_inc_x=np.exp(1j*(sin_theta_kr*np.cos(phi - phip) + cos_theta_kz))#phase for the X incident component
-                    phase_inc_y=np.exp(1j*(-sin_theta_kr*np.sin(phi - phip) + cos_theta_kz))#phase for the Y incident component
-                    #now, the integration is made as the sum of the value of the integrand in each position of phi,theta:
-                    Ex_XZ[j,i]=np.sum(Axx*phase_inc_x)+np.sum(Ayx*phase_inc_y)
-                    Ey_XZ[j,i]=np.sum(Axy*phase_inc_x)+np.sum(Ayy*phase_inc_y)
-                    Ez_XZ[j,i]=np.sum(Axz*phase_inc_x)+np.sum(Ayz*phase_inc_y)
-        else:
-            print('Options for plot_plane are \'X\' and \'Y\' ')
+        raise ValueError('Options for plot_plane are \'X\' and \'Y\'')
+    kr_values=np.abs(x_values)*2*np.pi/Lambda
+    kz_values=z_values*2*np.pi/Lambda
+
+    #pixel p maps to matrix position [j,i] with j=p//resolution_focus (the Z coordinate) and i=p%resolution_focus:
+    kr_pixels=np.tile(kr_values,resolution_z).astype(sin_theta.dtype,order='C')
+    cos_phip_pixels=np.tile(np.cos(phip_values),resolution_z).astype(sin_theta.dtype,order='C')
+    sin_phip_pixels=np.tile(np.sin(phip_values),resolution_z).astype(sin_theta.dtype,order='C')
+    kz_pixels=np.repeat(kz_values,resolution_focus).astype(sin_theta.dtype,order='C')
+
+    ex_flat=np.zeros(resolution_z*resolution_focus,dtype=Axx.dtype)
+    ey_flat=np.zeros(resolution_z*resolution_focus,dtype=Axx.dtype)
+    ez_flat=np.zeros(resolution_z*resolution_focus,dtype=Axx.dtype)
+    _focus_field_pixel_loop(ex_flat,ey_flat,ez_flat,Axx,Axy,Axz,Ayx,Ayy,Ayz,sin_theta,cos_theta,cos_phi,sin_phi,kr_pixels,cos_phip_pixels,sin_phip_pixels,kz_pixels)
+    Ex_XZ=ex_flat.reshape(resolution_z,resolution_focus)
+    Ey_XZ=ey_flat.reshape(resolution_z,resolution_focus)
+    Ez_XZ=ez_flat.reshape(resolution_z,resolution_focus)
+
     Ex_XZ*=-1j*focus/Lambda
     Ey_XZ*=1j*focus/Lambda
     Ez_XZ*=1j*focus/Lambda